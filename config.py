@@ -1,2 +1,6 @@
 # config.py
 BOT_TOKEN = "7778834899:AAEs7eazNIyXw71cQ79nFUDj81gx9MnTfig"
+
+# Домен для webhook (например, "bot.example.com"). None – работа через long polling
+WEBHOOK_DOMAIN = None
+WEBHOOK_PORT = 8443
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
+import atexit
+import contextlib
+import html
 import logging
 import asyncio
 import sqlite3
-from datetime import datetime, timedelta, date
-import pytz
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+from datetime import datetime, timedelta, date, time as dt_time
+from zoneinfo import ZoneInfo
 from telegram import (
     Update, 
     BotCommand, 
@@ -12,13 +19,12 @@ from telegram import (
     InlineKeyboardMarkup, 
     InlineKeyboardButton
 )
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 from astral import Observer
 from astral.sun import sun
-from timezonefinder import TimezoneFinder
 
-from config import BOT_TOKEN
+from config import BOT_TOKEN, WEBHOOK_DOMAIN, WEBHOOK_PORT
 
 #############################################
 # Глобальные переменные и настройки
@@ -26,18 +32,89 @@ from config import BOT_TOKEN
 
 global_location = None
 subscribed_chats = {}
-notified_events_global = {}
+notified_by_day = defaultdict(set)  # день -> {(chat_id, event, offset)}
+_date_str_cache = (None, None)
+_DB = None
+_notify_task = None
+_reschedule = asyncio.Event()
+_DB_LOCK = threading.Lock()
+_send_semaphore = asyncio.Semaphore(25)
 DATABASE_NAME = "global_settings.db"
 REMINDER_OFFSET = 10  # базовое смещение – используется для уведомлений, далее будут 10, 30 и 60 мин
+NOTIFY_OFFSETS = [10, 30, 60]  # уведомления за 10, 30 и 60 минут до события
+_FMT_TIME = "%H:%M:%S"
+_MENTION_TMPL = "<a href='tg://user?id=%d'>%s</a>"
+EVENT_LABELS = {"sunrise": "восхода 🌅", "sunset": "заката 🌇"}
+
+#############################################
+# Вспомогательные функции
+#############################################
+
+@lru_cache(maxsize=8)
+def _get_tz(tz_str: str):
+    # Часовой пояс меняется только при /setlocation, поэтому объект tz кэшируем
+    return ZoneInfo(tz_str)
+
+def _timezone_at(lat: float, lon: float) -> str:
+    # tzfpy загружает данные часовых поясов при импорте – откладываем до первого /setlocation
+    from tzfpy import get_tz
+    return get_tz(lon, lat) or "UTC"
+
+def make_location(lat: float, lon: float, tz_str: str) -> dict:
+    # tz не меняется до следующего /setlocation – получаем его один раз
+    return {"lat": lat, "lon": lon, "tz": tz_str, "_tz": _get_tz(tz_str)}
+
+@lru_cache(maxsize=64)
+def _compute_sun(lat: float, lon: float, tz_str: str, ordinal: int) -> dict:
+    # Восход/закат для (lat, lon, день) не меняются в течение суток – считаем один раз
+    return sun(Observer(latitude=lat, longitude=lon), date=date.fromordinal(ordinal), tzinfo=_get_tz(tz_str))
+
+def get_sun(location: dict, day: date) -> dict:
+    return _compute_sun(location['lat'], location['lon'], location['tz'], day.toordinal())
+
+def add_subscriber(chat_id: int, user_id: int, name: str) -> bool:
+    # Строки упоминаний пересобираются только при изменении списка подписчиков
+    if chat_id not in subscribed_chats:
+        subscribed_chats[chat_id] = {"users": {}, "mentions": "", "mentions_plain": ""}
+    subs = subscribed_chats[chat_id]
+    old_name = subs["users"].get(user_id)
+    if old_name == name:
+        return False
+    subs["users"][user_id] = name
+    if old_name is None and len(subs["users"]) > 1:
+        # Новый подписчик – дописываем его в конец, не пересобирая всю строку
+        subs["mentions"] += " " + _MENTION_TMPL % (user_id, html.escape(name))
+        subs["mentions_plain"] += " " + name
+    else:
+        subs["mentions"] = " ".join(_MENTION_TMPL % (uid, html.escape(n)) for uid, n in subs["users"].items())
+        subs["mentions_plain"] = " ".join(subs["users"].values())
+    return True
+
+def local_today() -> date:
+    # Отметки уведомлений хранятся по дате локации, а не по дате сервера
+    if global_location:
+        return datetime.now(global_location['_tz']).date()
+    return date.today()
+
+def fmt_date(d: date) -> str:
+    # Строка даты одна на весь день; isoformat() быстрее strftime("%Y-%m-%d")
+    global _date_str_cache
+    if _date_str_cache[0] != d:
+        _date_str_cache = (d, d.isoformat())
+    return _date_str_cache[1]
 
 #############################################
 # Функции работы с базой данных
 #############################################
 
 def init_db():
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+    # Одно соединение на весь процесс: без повторного открытия файла и прогрева кэша страниц
+    global _DB
+    _DB = sqlite3.connect(DATABASE_NAME, check_same_thread=False, isolation_level=None)
+    _DB.execute("PRAGMA journal_mode=WAL")
+    _DB.execute("PRAGMA synchronous=NORMAL")
+    atexit.register(_DB.close)
+    _DB.execute('''
         CREATE TABLE IF NOT EXISTS global_settings (
             id INTEGER PRIMARY KEY,
             lat REAL,
@@ -45,25 +122,65 @@ def init_db():
             tz TEXT
         )
     ''')
-    conn.commit()
-    cursor.execute("SELECT lat, lon, tz FROM global_settings WHERE id = 1")
-    row = cursor.fetchone()
+    _DB.execute('''
+        CREATE TABLE IF NOT EXISTS subscribers (
+            chat_id INTEGER,
+            user_id INTEGER,
+            name TEXT,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+    _DB.execute('''
+        CREATE TABLE IF NOT EXISTS notified (
+            chat_id INTEGER,
+            day TEXT,
+            event TEXT,
+            offset_min INTEGER,
+            PRIMARY KEY (chat_id, day, event, offset_min)
+        )
+    ''')
+    row = _DB.execute("SELECT lat, lon, tz FROM global_settings WHERE id = 1").fetchone()
     if row:
         global global_location
-        global_location = {"lat": row[0], "lon": row[1], "tz": row[2]}
+        global_location = make_location(row[0], row[1], row[2])
         logging.info("Локация загружена: %s", global_location)
-    conn.close()
+    # Подписчики и уже отправленные уведомления переживают перезапуск бота
+    for chat_id, user_id, name in _DB.execute("SELECT chat_id, user_id, name FROM subscribers"):
+        add_subscriber(chat_id, user_id, name)
+    rows = _DB.execute(
+        "SELECT chat_id, day, event, offset_min FROM notified WHERE day >= ?", (local_today().isoformat(),)
+    )
+    for chat_id, day, event, offset in rows:
+        notified_by_day[date.fromisoformat(day)].add((chat_id, event, offset))
+    logging.info("Загружено подписанных чатов: %d", len(subscribed_chats))
 
+# Функции записи ниже вызываются из рабочих потоков (asyncio.to_thread),
+# поэтому доступ к общему соединению сериализуется блокировкой
 def save_global_location(lat: float, lon: float, tz: str):
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM global_settings WHERE id = 1")
-    if cursor.fetchone():
-        cursor.execute("UPDATE global_settings SET lat = ?, lon = ?, tz = ? WHERE id = 1", (lat, lon, tz))
-    else:
-        cursor.execute("INSERT INTO global_settings (id, lat, lon, tz) VALUES (1, ?, ?, ?)", (lat, lon, tz))
-    conn.commit()
-    conn.close()
+    with _DB_LOCK:
+        _DB.execute(
+            "INSERT INTO global_settings (id, lat, lon, tz) VALUES (1, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET lat = excluded.lat, lon = excluded.lon, tz = excluded.tz",
+            (lat, lon, tz)
+        )
+
+def save_subscriber(chat_id: int, user_id: int, name: str):
+    with _DB_LOCK:
+        _DB.execute(
+            "INSERT OR REPLACE INTO subscribers (chat_id, user_id, name) VALUES (?, ?, ?)",
+            (chat_id, user_id, name)
+        )
+
+def save_notified(chat_id: int, day: date, event: str, offset: int):
+    with _DB_LOCK:
+        _DB.execute(
+            "INSERT OR IGNORE INTO notified (chat_id, day, event, offset_min) VALUES (?, ?, ?, ?)",
+            (chat_id, day.isoformat(), event, offset)
+        )
+
+def delete_notified_before(day: date):
+    with _DB_LOCK:
+        _DB.execute("DELETE FROM notified WHERE day < ?", (day.isoformat(),))
 
 #############################################
 # Обработчики команд
@@ -82,9 +199,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def setlocation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_type = update.effective_chat.type
     if chat_type in ("group", "supergroup"):
-        me = await context.bot.get_me()
-        bot_username = me.username
-        url = f"https://t.me/{bot_username}?start=setlocation"
+        # username кэшируется ботом при инициализации приложения – без запроса get_me()
+        url = f"https://t.me/{context.bot.username}?start=setlocation"
         inline_kb = InlineKeyboardMarkup.from_button(
             InlineKeyboardButton("👤 В ЛС", url=url)
         )
@@ -99,11 +215,11 @@ async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if update.message.location:
         lat = update.message.location.latitude
         lon = update.message.location.longitude
-        tf = TimezoneFinder()
-        tz_str = tf.timezone_at(lng=lon, lat=lat) or "UTC"
+        tz_str = await asyncio.to_thread(_timezone_at, lat, lon)
         global global_location
-        global_location = {"lat": lat, "lon": lon, "tz": tz_str}
-        save_global_location(lat, lon, tz_str)
+        global_location = make_location(lat, lon, tz_str)
+        await asyncio.to_thread(save_global_location, lat, lon, tz_str)
+        reschedule_notifications()
         await update.message.reply_text(f"Локация: {lat}, {lon} (tz: {tz_str}) ✅")
     else:
         await update.message.reply_text("❌ Локация не получена.")
@@ -113,36 +229,31 @@ async def times(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Локация не установлена. Используй /setlocation")
         return
 
-    lat = global_location['lat']
-    lon = global_location['lon']
-    tz_str = global_location['tz']
-    tz = pytz.timezone(tz_str)
-    now = datetime.now(tz)
-    observer = Observer(latitude=lat, longitude=lon)
+    tz = global_location['_tz']
+    today = datetime.now(tz).date()
     try:
         # Получаем данные на сегодня
-        s_today = sun(observer, date=now.date(), tzinfo=tz)
+        s_today = get_sun(global_location, today)
         # Получаем данные на завтра
-        tomorrow_date = now.date() + timedelta(days=1)
-        s_tomorrow = sun(observer, date=tomorrow_date, tzinfo=tz)
+        tomorrow_date = today + timedelta(days=1)
+        s_tomorrow = get_sun(global_location, tomorrow_date)
     except Exception as e:
         logging.exception("Ошибка расчёта")
         await update.message.reply_text("Ошибка расчёта времени ❌")
         return
 
-    sunrise_today = s_today["sunrise"].strftime("%H:%M:%S")
-    sunset_today = s_today["sunset"].strftime("%H:%M:%S")
-    sunrise_tomorrow = s_tomorrow["sunrise"].strftime("%H:%M:%S")
-    sunset_tomorrow = s_tomorrow["sunset"].strftime("%H:%M:%S")
+    sunrise_today = s_today["sunrise"].strftime(_FMT_TIME)
+    sunset_today = s_today["sunset"].strftime(_FMT_TIME)
+    sunrise_tomorrow = s_tomorrow["sunrise"].strftime(_FMT_TIME)
+    sunset_tomorrow = s_tomorrow["sunset"].strftime(_FMT_TIME)
 
-    date_today_str = now.strftime("%Y-%m-%d")
-    date_tomorrow_str = tomorrow_date.strftime("%Y-%m-%d")
+    date_today_str = fmt_date(today)
+    date_tomorrow_str = tomorrow_date.isoformat()
 
     chat_id = update.effective_chat.id
     user = update.effective_user
-    if chat_id not in subscribed_chats:
-        subscribed_chats[chat_id] = {}
-    subscribed_chats[chat_id][user.id] = user.first_name
+    if add_subscriber(chat_id, user.id, user.first_name):
+        await asyncio.to_thread(save_subscriber, chat_id, user.id, user.first_name)
 
     text = (f"— Сегодня ({date_today_str}) —\n"
             f"🌅 Восход: {sunrise_today}\n"
@@ -156,82 +267,141 @@ async def times(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 # Хелпер для отправки уведомлений
 #############################################
 
-async def send_notification(chat_id, msg, key):
+async def _send_html_or_plain(chat_id, msg, plain_msg):
     try:
         await application.bot.send_message(chat_id, msg, parse_mode="HTML")
-        notified_events_global[key] = True
-    except Exception as e:
-        logging.exception("Ошибка уведомления в чате %s, пробую отправить без HTML", chat_id)
+    except BadRequest:
+        logging.warning("Ошибка HTML в чате %s, отправляю без HTML", chat_id)
+        await application.bot.send_message(chat_id, plain_msg)
+
+async def send_notification(chat_id, msg, plain_msg, key):
+    # Семафор ограничивает число одновременных запросов к API; скорость отправки
+    # (лимит Telegram – 30 сообщений/с) ограничивает AIORateLimiter
+    async with _send_semaphore:
+        # Повтор после RetryAfter выполняет AIORateLimiter (max_retries=1)
         try:
-            plain_msg = msg.replace("<a href='tg://user?id=", "").replace("'>", " ").replace("</a>", "")
-            await application.bot.send_message(chat_id, plain_msg)
-            notified_events_global[key] = True
-        except Exception as e2:
+            await _send_html_or_plain(chat_id, msg, plain_msg)
+        except TelegramError:
             logging.exception("Не удалось отправить уведомление в чате %s", chat_id)
+            return
+    _, day, event, offset = key
+    notified_by_day[day].add((chat_id, event, offset))
+    await asyncio.to_thread(save_notified, *key)
 
 #############################################
 # Механизм уведомлений
 #############################################
 
-async def job_wrapper():
-    try:
-        await check_notifications()
-    except Exception as e:
-        logging.exception("Unhandled exception in job_wrapper: %s", e)
-
-async def check_notifications():
+async def fire_notification(event: str, offset: int, day: date):
+    # Вызывается циклом уведомлений в момент «событие − offset минут»
+    if not subscribed_chats:
+        return
+    # Общая часть сообщения одна для всех чатов, в цикле только добавляем упоминания
+    prefix = f"📅 {fmt_date(day)}\n⏰ {offset} мин до {EVENT_LABELS[event]} "
+    sent = notified_by_day.get(day, ())
+    tasks = []
+    for chat_id, subs in subscribed_chats.items():
+        if (chat_id, event, offset) in sent:
+            continue
+        key = (chat_id, day, event, offset)
+        tasks.append(send_notification(chat_id, prefix + subs['mentions'], prefix + subs['mentions_plain'], key))
+    # Чаты независимы – отправляем параллельно, а не по одному
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logging.error("Ошибка при рассылке уведомления", exc_info=result)
+
+def upcoming_notifications(now: datetime) -> list:
+    # Уведомления на сегодня и завтра: завтрашний день учитываем заранее,
+    # чтобы не потерять уведомления, попадающие на вечер предыдущих суток.
+    # Время считаем в POSIX-секундах: разность aware-datetime с одним tzinfo
+    # не учитывает переход на летнее/зимнее время
+    today = now.date()
+    now_ts = now.timestamp()
+    pending = []
+    for day in (today, today + timedelta(days=1)):
+        try:
+            s = get_sun(global_location, day)
+        except Exception as e:
+            logging.exception("Ошибка расчёта для уведомлений на %s", day)
+            continue
+        for event in EVENT_LABELS:
+            for offset in NOTIFY_OFFSETS:
+                run_ts = s[event].timestamp() - offset * 60
+                if run_ts > now_ts:
+                    pending.append((run_ts, event, offset, day))
+    pending.sort()
+    return pending
+
+async def _sleep_until(ts: float) -> bool:
+    # Ждём момента ts (POSIX-время); True – если сон прерван сменой локации
     try:
-        if not global_location:
-            return
-        lat = global_location['lat']
-        lon = global_location['lon']
-        tz_str = global_location['tz']
-        tz = pytz.timezone(tz_str)
-        now = datetime.now(tz)
-        observer = Observer(latitude=lat, longitude=lon)
+        await asyncio.wait_for(_reschedule.wait(), timeout=max(ts - time.time(), 0))
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def notification_loop():
+    # Спим до ближайшего уведомления, отправляем его и пересчитываем следующее.
+    # Смена локации не отменяет задачу, а будит её через _reschedule,
+    # поэтому начатая рассылка всегда доходит до всех чатов
+    cleaned_day = None
+    while True:
         try:
-            s = sun(observer, date=now.date(), tzinfo=tz)
+            _reschedule.clear()
+            if not global_location:
+                await _reschedule.wait()
+                continue
+            # Отметки прошедших дней удаляем один раз за сутки, а не на каждом проходе
+            today = local_today()
+            if today != cleaned_day:
+                await clear_notified_events()
+                cleaned_day = today
+            tz = global_location['_tz']
+            now = datetime.now(tz)
+            pending = upcoming_notifications(now)
+            if not pending:
+                # Полярный день/ночь: событий нет – проверяем снова в начале следующих суток
+                wake = datetime.combine(now.date() + timedelta(days=1), dt_time(0, 1), tzinfo=tz)
+                await _sleep_until(wake.timestamp())
+                continue
+            if await _sleep_until(pending[0][0]):
+                continue
+            now_ts = time.time()
+            for run_ts, event, offset, day in pending:
+                if run_ts > now_ts:
+                    break
+                try:
+                    await fire_notification(event, offset, day)
+                except Exception as e:
+                    logging.exception("Ошибка уведомления %s/%s", event, offset)
         except Exception as e:
-            logging.exception("Ошибка расчёта для уведомлений")
-            return
+            logging.exception("Ошибка в цикле уведомлений")
+            await asyncio.sleep(60)
+
+def _on_notify_task_done(task: asyncio.Task):
+    if task.cancelled():
+        logging.info("Цикл уведомлений остановлен.")
+    elif task.exception() is not None:
+        logging.error("Цикл уведомлений завершился с ошибкой", exc_info=task.exception())
+    else:
+        logging.error("Цикл уведомлений неожиданно завершился")
 
-        sunrise_dt = s["sunrise"]
-        sunset_dt = s["sunset"]
-        date_str = now.strftime("%Y-%m-%d")
-        offsets = [10, 30, 60]  # уведомления за 10, 30 и 60 минут до события
-
-        for chat_id, subs in subscribed_chats.items():
-            mentions = " ".join([f"<a href='tg://user?id={uid}'>{name}</a>" for uid, name in subs.items()])
-            for offset in offsets:
-                # Уведомление для восхода
-                sunrise_notif = sunrise_dt - timedelta(minutes=offset)
-                key_sr = (chat_id, now.date(), "sunrise", offset)
-                if key_sr not in notified_events_global:
-                    if now >= sunrise_notif and now < sunrise_notif + timedelta(seconds=60):
-                        msg = f"📅 {date_str}\n⏰ {offset} мин до восхода 🌅 {mentions}"
-                        await send_notification(chat_id, msg, key_sr)
-                # Уведомление для заката
-                sunset_notif = sunset_dt - timedelta(minutes=offset)
-                key_ss = (chat_id, now.date(), "sunset", offset)
-                if key_ss not in notified_events_global:
-                    if now >= sunset_notif and now < sunset_notif + timedelta(seconds=60):
-                        msg = f"📅 {date_str}\n⏰ {offset} мин до заката 🌇 {mentions}"
-                        await send_notification(chat_id, msg, key_ss)
-    except Exception as e:
-        logging.exception("Unhandled exception in check_notifications: %s", e)
+def start_notifications():
+    global _notify_task
+    _notify_task = asyncio.create_task(notification_loop())
+    _notify_task.add_done_callback(_on_notify_task_done)
+    logging.info("Цикл уведомлений запущен.")
 
-def clear_notified_events():
-    today = date.today()
-    keys = [k for k in notified_events_global if k[1] != today]
-    for k in keys:
-        del notified_events_global[k]
+def reschedule_notifications():
+    # Вызывается после смены локации: цикл пересчитает ближайшие уведомления
+    _reschedule.set()
 
-async def start_scheduler():
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(lambda: asyncio.create_task(job_wrapper()), 'interval', seconds=30)
-    scheduler.add_job(clear_notified_events, 'cron', hour=0, minute=1)
-    scheduler.start()
-    logging.info("Scheduler запущен.")
+async def clear_notified_events():
+    # Отметки хранятся по дням – прошедшие дни удаляются целиком
+    today = local_today()
+    for d in [d for d in notified_by_day if d < today]:
+        del notified_by_day[d]
+    await asyncio.to_thread(delete_notified_before, today)
 
 async def set_bot_commands(app: Application) -> None:
     cmds = [
@@ -243,6 +413,19 @@ async def set_bot_commands(app: Application) -> None:
     await app.bot.set_my_commands(cmds)
     logging.info("Команды установлены.")
 
+async def on_startup(app: Application) -> None:
+    # post_init выполняется в цикле событий самого PTB, один раз перед началом polling
+    start_notifications()
+    await set_bot_commands(app)
+
+async def on_stop(app: Application) -> None:
+    # post_stop выполняется до shutdown(), пока HTTP-клиент бота ещё открыт:
+    # дожидаемся отмены, чтобы задача не осталась висеть при закрытии цикла событий
+    if _notify_task is not None:
+        _notify_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _notify_task
+
 #############################################
 # Команда тестирования уведомлений (/test)
 #############################################
@@ -252,22 +435,18 @@ async def test(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Локация не установлена. Используй /setlocation")
         return
 
-    lat = global_location['lat']
-    lon = global_location['lon']
-    tz_str = global_location['tz']
-    tz = pytz.timezone(tz_str)
-    now = datetime.now(tz)
-    observer = Observer(latitude=lat, longitude=lon)
+    tz = global_location['_tz']
+    today = datetime.now(tz).date()
     try:
-        s = sun(observer, date=now.date(), tzinfo=tz)
+        s = get_sun(global_location, today)
     except Exception as e:
         logging.exception("Ошибка расчёта для теста")
         await update.message.reply_text("Ошибка расчёта времени для теста ❌")
         return
 
-    sunrise = s["sunrise"].strftime("%H:%M:%S")
-    sunset = s["sunset"].strftime("%H:%M:%S")
-    date_str = now.strftime("%Y-%m-%d")
+    sunrise = s["sunrise"].strftime(_FMT_TIME)
+    sunset = s["sunset"].strftime(_FMT_TIME)
+    date_str = fmt_date(today)
     test_msg_sr = f"[TEST] 📅 {date_str}\n⏰ 10 мин до восхода 🌅 (тестовое уведомление)"
     test_msg_ss = f"[TEST] 📅 {date_str}\n⏰ 10 мин до заката 🌇 (тестовое уведомление)"
     await update.message.reply_text(f"Тест: время восхода {sunrise}, время заката {sunset}")
@@ -281,16 +460,36 @@ async def test(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 def main():
     global application
     init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("setlocation", setlocation))
-    application.add_handler(CommandHandler("times", times))
-    application.add_handler(CommandHandler("test", test))
-    application.add_handler(MessageHandler(filters.LOCATION, location_handler))
-    loop = asyncio.get_event_loop()
-    loop.create_task(start_scheduler())
-    loop.create_task(set_bot_commands(application))
-    application.run_polling()
+    # Ограничитель скорости PTB ставит отправки в очередь и сам обрабатывает RetryAfter
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=28, overall_time_period=1,
+        group_max_rate=18, group_time_period=60,
+        max_retries=1
+    )
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(rate_limiter)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .build()
+    )
+    # block=False: обработчики не ждут друг друга и выполняются параллельно
+    application.add_handler(CommandHandler("start", start, block=False))
+    application.add_handler(CommandHandler("setlocation", setlocation, block=False))
+    application.add_handler(CommandHandler("times", times, block=False))
+    application.add_handler(CommandHandler("test", test, block=False))
+    application.add_handler(MessageHandler(filters.LOCATION, location_handler, block=False))
+    if WEBHOOK_DOMAIN:
+        # Telegram сам доставляет обновления – без постоянных запросов getUpdates
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"https://{WEBHOOK_DOMAIN}/{BOT_TOKEN}"
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()